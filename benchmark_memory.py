@@ -0,0 +1,112 @@
+# -------------------------
+# -------- IMPORTS --------
+# -------------------------
+import os
+import sys
+import gc
+import random
+import resource
+import subprocess
+import pandas as pd
+
+import config
+from frames import optimize_dtypes, concat_frames
+
+# -------------------------------------------
+# -------   DATAFRAME MEMORY BENCHMARK  -----
+# -------------------------------------------
+# Compares the RSS of a customers DataFrame held as object columns (the original formatter output)
+# with the compact dtypes of frames.py. Each mode runs in its own process so the RSS is not
+# polluted by the other one.
+#
+# Usage: python benchmark_memory.py [rows]     (default: 1,000,000 customers)
+
+PAGE_SIZE = 1000
+CATEGORICAL_COLUMNS = config.CATEGORICAL_COLUMNS.get(config.BQ_CUSTOMER_TABLE_ID, [])
+
+def current_rss_mb():
+    """
+    Returns the resident set size of this process in MB (peak RSS where /proc is not available).
+    """
+    try:
+        with open("/proc/self/statm") as f:
+            return int(f.read().split()[1]) * os.sysconf("SC_PAGE_SIZE") / 1e6
+    except (OSError, ValueError):
+        peak = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+        return peak / 1e6 if sys.platform == "darwin" else peak / 1e3
+
+def customer_rows(start, count):
+    """
+    Generates synthetic rows with the columns produced by format_customer_data.
+    """
+    rng = random.Random(start)
+    groups = {1: "General", 2: "Wholesale", 3: "Retailer", 4: "VIP"}
+    countries = ["FR", "DE", "US", "GB", "ES", "IT", "NL", "BE"]
+    for customer_id in range(start, start + count):
+        group_id = rng.choice(list(groups))
+        country = rng.choice(countries)
+        first, last = f"First{customer_id % 5000}", f"Last{customer_id % 20000}"
+        yield {
+            "Customer_ID": customer_id,
+            "Email": f"customer{customer_id}@example.com",
+            "First_Name": first,
+            "Last_Name": last,
+            "Full_Name": f"{first} {last}",
+            "Created_At": f"20{rng.randint(15, 24)}-{rng.randint(1, 12):02d}-{rng.randint(1, 28):02d} 10:00:00",
+            "Updated_At": f"2025-{rng.randint(1, 12):02d}-{rng.randint(1, 28):02d} 10:00:00",
+            "Group_ID": group_id,
+            "Group_Name": groups[group_id],
+            "Is_Subscribed": str(rng.random() < 0.3),
+            "Billing_Street": f"{rng.randint(1, 200)} Main Street",
+            "Billing_City": f"City{rng.randint(1, 2000)}",
+            "Billing_Region": f"Region{rng.randint(1, 50)}",
+            "Billing_Postcode": f"{rng.randint(10000, 99999)}",
+            "Billing_Country": country,
+            "Billing_Telephone": f"+33{rng.randint(100000000, 999999999)}",
+            "Shipping_Street": f"{rng.randint(1, 200)} Main Street",
+            "Shipping_City": f"City{rng.randint(1, 2000)}",
+            "Shipping_Region": f"Region{rng.randint(1, 50)}",
+            "Shipping_Postcode": f"{rng.randint(10000, 99999)}",
+            "Shipping_Country": country,
+            "Shipping_Telephone": f"+33{rng.randint(100000000, 999999999)}",
+            "Gender": rng.choice(["", "1", "2", "3"]),
+            "Date_Of_Birth": "",
+            "VAT_Number": "",
+            "Company": "",
+            "Account_Status": "1",
+            "Total_Address_Count": rng.randint(0, 3),
+        }
+
+def build_customers(rows, compact):
+    """
+    Builds the customers DataFrame page by page, like the pipeline does.
+    """
+    frames = []
+    for start in range(0, rows, PAGE_SIZE):
+        df_page = pd.DataFrame(list(customer_rows(start, min(PAGE_SIZE, rows - start))))
+        if not compact:
+            # Object columns, as formatted before, whatever the default string dtype of the pandas version
+            string_columns = [col for col in df_page.columns if not pd.api.types.is_numeric_dtype(df_page[col])]
+            df_page[string_columns] = df_page[string_columns].astype(object)
+        frames.append(optimize_dtypes(df_page, CATEGORICAL_COLUMNS) if compact else df_page)
+    return concat_frames(frames) if compact else pd.concat(frames, ignore_index=True)
+
+def measure(mode, rows):
+    """
+    Builds the DataFrame in the given mode and prints the RSS it added to the process.
+    """
+    gc.collect()
+    rss_before = current_rss_mb()
+    df_customers = build_customers(rows, compact=(mode == "compact"))
+    gc.collect()
+    rss_after = current_rss_mb()
+    print(f"{mode:>8}: {len(df_customers)} rows, RSS +{rss_after - rss_before:.1f} MB "
+          f"(DataFrame {df_customers.memory_usage(deep=True).sum() / 1e6:.1f} MB)")
+
+if __name__ == "__main__":
+    if len(sys.argv) > 2:
+        measure(sys.argv[2], int(sys.argv[1]))
+    else:
+        rows = sys.argv[1] if len(sys.argv) > 1 else "1000000"
+        for mode in ("object", "compact"):
+            subprocess.run([sys.executable, __file__, rows, mode], check=True)
@@ -16,11 +16,182 @@ BQ_DATASET_ID = os.getenv("BQ_DATASET_ID", )        # "dataset-id"
 BQ_ORDER_TABLE_ID = "orders"                        # "table-id"
 BQ_CUSTOMER_TABLE_ID = "customers"                  # "table-id"
 
+# Multi-Store Mode (leave STORES empty to sync only the store configured above)
+STORES = [
+    # {
+    #     "name": "store-fr",                           # Used in logs and as the archive sub-directory
+    #     "base_url": "https://fr.your-magento-store.com",
+    #     "access_token": "",                           # Integration token, leave empty to log in with username/password and OTP
+    #     "username": "",
+    #     "password": "",
+    #     "dataset_id": "magento_fr",                   # Target BigQuery dataset of this store
+    #     "rate_limit": 2,                              # Magento requests per second for this store
+    # },
+]
+M2_RATE_LIMIT = 1                                   # Default Magento requests per second, per store
+FETCH_WORKERS = 4                                   # Shared workers fetching from Magento, across all stores
+LOAD_WORKERS = 2                                    # Shared workers comparing and loading into BigQuery, across all stores
+PAGE_WORKERS = 4                                    # Concurrent page requests per entity fetch (within the store's rate limit)
+M2_MAX_RETRIES = 3                                  # Retries of a Magento request answered with 429 or 5xx, with exponential backoff
+
+# Entity Registry (every entity is fetched, archived, formatted and loaded by the same generic engine)
+#   endpoint:     Magento REST search endpoint, relative to /rest/V1/
+#   table_id:     Target BigQuery table
+#   filter_field: Date field filtered with FROM_DATE and TO_DATE (None to fetch everything)
+#   cursor_field: Field the pages are sorted on, also the date partition of the archive (None for snapshot entities)
+#   id_field:     Magento primary key (a list of fields for composite keys)
+#   primary_key:  BigQuery primary key column
+#   page_size:    Items per Magento request
+#   fields:       Projected item fields (None for the full items, which the archive needs to replay later formatter changes)
+#   columns:      {BigQuery column: item field}, "a.b" for nested fields, a list of fields to join them with ":"
+#   formatter:    Hand-written formatter used instead of columns ("orders" or "customers")
+ENTITIES = {
+    "customers": {
+        "endpoint": "customers/search",
+        "table_id": BQ_CUSTOMER_TABLE_ID,
+        "filter_field": "updated_at",
+        "cursor_field": "updated_at",
+        "id_field": "id",
+        "primary_key": "Customer_ID",
+        "page_size": 100,
+        "fields": None,
+        "formatter": "customers",
+    },
+    "orders": {
+        "endpoint": "orders",
+        "table_id": BQ_ORDER_TABLE_ID,
+        "filter_field": "created_at",
+        "cursor_field": "created_at",
+        "id_field": "entity_id",
+        "primary_key": "Order_ID",
+        "page_size": 50,
+        "fields": None,
+        "formatter": "orders",
+    },
+    "products": {
+        "endpoint": "products",
+        "table_id": "products",
+        "filter_field": "updated_at",
+        "cursor_field": "updated_at",
+        "id_field": "id",
+        "primary_key": "Product_ID",
+        "page_size": 100,
+        "fields": "id,sku,name,type_id,status,visibility,price,attribute_set_id,created_at,updated_at",
+        "columns": {
+            "Product_ID": "id",
+            "SKU": "sku",
+            "Name": "name",
+            "Type": "type_id",
+            "Status": "status",
+            "Visibility": "visibility",
+            "Price": "price",
+            "Attribute_Set_ID": "attribute_set_id",
+            "Created_At": "created_at",
+            "Updated_At": "updated_at",
+        },
+    },
+    "invoices": {
+        "endpoint": "invoices",
+        "table_id": "invoices",
+        "filter_field": "updated_at",
+        "cursor_field": "updated_at",
+        "id_field": "entity_id",
+        "primary_key": "Invoice_ID",
+        "page_size": 100,
+        "fields": "entity_id,increment_id,order_id,state,grand_total,order_currency_code,created_at,updated_at",
+        "columns": {
+            "Invoice_ID": "entity_id",
+            "Increment_ID": "increment_id",
+            "Order_ID": "order_id",
+            "State": "state",
+            "Grand_Total": "grand_total",
+            "Currency": "order_currency_code",
+            "Created_At": "created_at",
+            "Updated_At": "updated_at",
+        },
+    },
+    "creditmemos": {
+        "endpoint": "creditmemos",
+        "table_id": "credit_memos",
+        "filter_field": "updated_at",
+        "cursor_field": "updated_at",
+        "id_field": "entity_id",
+        "primary_key": "Credit_Memo_ID",
+        "page_size": 100,
+        "fields": "entity_id,increment_id,order_id,invoice_id,state,grand_total,order_currency_code,created_at,updated_at",
+        "columns": {
+            "Credit_Memo_ID": "entity_id",
+            "Increment_ID": "increment_id",
+            "Order_ID": "order_id",
+            "Invoice_ID": "invoice_id",
+            "State": "state",
+            "Grand_Total": "grand_total",
+            "Currency": "order_currency_code",
+            "Created_At": "created_at",
+            "Updated_At": "updated_at",
+        },
+    },
+    "stock": {
+        "endpoint": "inventory/source-items",
+        "table_id": "stock",
+        "filter_field": None,
+        "cursor_field": None,
+        "id_field": ["source_code", "sku"],
+        "primary_key": "Source_Item_ID",
+        "page_size": 500,
+        "fields": "source_code,sku,quantity,status",
+        "columns": {
+            "Source_Item_ID": ["source_code", "sku"],
+            "Source_Code": "source_code",
+            "SKU": "sku",
+            "Quantity": "quantity",
+            "Status": "status",
+        },
+    },
+}
+SYNC_ENTITIES = ["customers", "orders"]             # Entities synced by a run, in this order
+
+# Derived Columns (excluded from change detection, computed at query time in a view over the base table)
+BQ_VIEW_SUFFIX = "_view"                            # The view for table "customers" is "customers_view"
+DERIVED_COLUMNS = {                                 # {table-id: {column: BigQuery SQL expression}}
+    BQ_CUSTOMER_TABLE_ID: {
+        "Account_Age_Days": "DATE_DIFF(CURRENT_DATE(), DATE(SAFE_CAST(Created_At AS TIMESTAMP)), DAY)",
+    },
+}
+
+# Memory-compact DataFrames (low-cardinality columns are stored as categoricals, all others as Arrow-backed strings)
+CATEGORICAL_COLUMNS = {                             # {table-id: [columns]}
+    BQ_ORDER_TABLE_ID: ["Order_Status", "Country", "Payment_Method"],
+    BQ_CUSTOMER_TABLE_ID: ["Group_ID", "Group_Name", "Is_Subscribed", "Billing_Country", "Shipping_Country",
+                           "Gender", "Account_Status", "Total_Address_Count"],
+    "products": ["Type", "Status", "Visibility", "Attribute_Set_ID"],
+    "invoices": ["State", "Currency"],
+    "credit_memos": ["State", "Currency"],
+    "stock": ["Source_Code", "Status"],
+}
+
 # Date Range for Data Fetching
 FROM_DATE = "2025-01-02"
 TO_DATE = "2025-01-03"
 
 # Reset BQ Tables (True to reset data in BigQuery, False if incremental load)
 RESET = "False"                                     # Keep it as a string, not a boolean
+BQ_SHADOW_SUFFIX = "__shadow"                       # Reset runs are built in "<table-id>__shadow", then swapped in
+
+# Deletion Reconciliation (True to compare all Magento IDs against BigQuery and handle the deleted records)
+RECONCILE = "False"                                 # Keep it as a string, not a boolean
+RECONCILE_MODE = "tombstone"                        # "tombstone" sets Deleted_At on deleted rows, "delete" removes them
+RECONCILE_PAGE_SIZE = 1000                          # IDs fetched per Magento request
+
+# Dry-Run Planner and Budgets (None for no budget, budgets apply per store and per run)
+PLAN = "False"                                      # True to only estimate the Magento requests and BigQuery bytes of the run
+PLAN_SLICE_DAYS = 30                                # The date range is counted in slices of this many days
+MAX_API_CALLS = None                                # Skip a store whose run needs more Magento requests, abort it if it reaches them
+MAX_API_CALLS_PER_HOUR = None                       # Magento API quota, the store's rate limit is throttled to stay under it
+MAX_BQ_BYTES = None                                 # Skip a store whose planned queries scan more bytes, abort it if its queries bill more
 
+# Raw Page Archive (every page fetched from Magento is stored here as gzip-compressed JSON lines)
+ARCHIVE_DIR = os.getenv("ARCHIVE_DIR", "archive")   # Partitioned as <ARCHIVE_DIR>/<entity>/date=YYYY-MM-DD/pages.jsonl.gz
 
+# Replay Mode (True to rebuild tables from the local archive without calling Magento)
+REPLAY = "False"                                    # Keep it as a string, not a boolean
@@ -0,0 +1,56 @@
+# -------------------------
+# -------- IMPORTS --------
+# -------------------------
+import pandas as pd
+import pyarrow as pa
+from pandas.api.types import union_categoricals
+
+# -------------------------------------------
+# -------     COMPACT DATAFRAMES        -----
+# -------------------------------------------
+
+# Every BigQuery column is a STRING, held in pandas as an Arrow-backed string
+STRING_DTYPE = pd.StringDtype("pyarrow")
+
+def optimize_dtypes(df, categorical_columns):
+    """
+    Converts a formatted DataFrame to memory-compact dtypes, in place.
+    Every column becomes an Arrow-backed string (all BigQuery columns are STRINGs),
+    and the low-cardinality ones are stored as categoricals on top of it.
+    """
+    for col in df.columns:
+        values = df[col].astype(STRING_DTYPE)
+        df[col] = values.astype("category") if col in categorical_columns else values
+    return df
+
+def arrow_to_frame(arrow_table, categorical_columns):
+    """
+    Converts an Arrow table (a BigQuery query result) to a compact DataFrame.
+    String columns map straight to Arrow-backed strings, without an intermediate object copy,
+    and only the categorical columns are converted afterwards.
+    """
+    df = arrow_table.to_pandas(types_mapper=lambda arrow_type: STRING_DTYPE if pa.types.is_string(arrow_type) else None)
+    for col in categorical_columns:
+        if col in df.columns:
+            df[col] = df[col].astype(STRING_DTYPE).astype("category")
+    return df
+
+def concat_frames(frames):
+    """
+    Concatenates formatted pages while keeping their compact dtypes.
+    Categorical columns are first given the union of all pages' categories,
+    otherwise pd.concat falls back to object columns.
+    """
+    frames = [df for df in frames if not df.empty]
+    if not frames:
+        return pd.DataFrame()
+
+    for col in frames[0].columns:
+        if isinstance(frames[0][col].dtype, pd.CategoricalDtype):
+            categories = union_categoricals([df[col] for df in frames]).categories
+            for df in frames:
+                df[col] = df[col].cat.set_categories(categories)
+
+    df_all = pd.concat(frames, ignore_index=True)
+    print(f"Memory usage of {len(df_all)} rows: {df_all.memory_usage(deep=True).sum() / 1e6:.1f} MB")
+    return df_all
@@ -4,17 +4,23 @@
 # -------- IMPORTS --------
 # -------------------------
 import os
+import gzip
 import json
 import time
+import threading
 import requests
+from concurrent.futures import ThreadPoolExecutor, as_completed
+from functools import partial
+from requests.adapters import HTTPAdapter
+import numpy as np
 import pandas as pd
 from dotenv import load_dotenv
 from google.cloud import bigquery
-import pandas_gbq
 from tqdm import tqdm
 
 
 import config
+from frames import STRING_DTYPE, optimize_dtypes, concat_frames, arrow_to_frame
 # Magento 2 Credentials
 M2_BASE_URL = config.M2_BASE_URL            
 M2_ACCESS_TOKEN = config.M2_ACCESS_TOKEN
@@ -28,31 +34,67 @@ BQ_DATASET_ID = config.BQ_DATASET_ID
 BQ_ORDER_TABLE_ID = config.BQ_ORDER_TABLE_ID
 BQ_CUSTOMER_TABLE_ID = config.BQ_CUSTOMER_TABLE_ID
 
+# Multi-Store Mode (one entry per Magento instance, all synced through shared worker pools)
+STORES = config.STORES
+M2_RATE_LIMIT = config.M2_RATE_LIMIT
+FETCH_WORKERS = config.FETCH_WORKERS
+LOAD_WORKERS = config.LOAD_WORKERS
+PAGE_WORKERS = config.PAGE_WORKERS
+M2_MAX_RETRIES = config.M2_MAX_RETRIES
+
+# Entity Registry (declarative specs run by the generic entity engine)
+ENTITIES = config.ENTITIES
+SYNC_ENTITIES = config.SYNC_ENTITIES
+
+# Derived Columns (computed at query time in a view, never diffed or stored in the base table)
+BQ_VIEW_SUFFIX = config.BQ_VIEW_SUFFIX
+DERIVED_COLUMNS = config.DERIVED_COLUMNS
+
+# Memory-compact DataFrames (low-cardinality columns stored as categoricals)
+CATEGORICAL_COLUMNS = config.CATEGORICAL_COLUMNS
+
 # Date Range for Data Fetching
 FROM_DATE = config.FROM_DATE
 TO_DATE = config.TO_DATE
 
 # Reset BQ Tables (True to reset data in BigQuery, False if incremental load)
 RESET = config.RESET
+BQ_SHADOW_SUFFIX = config.BQ_SHADOW_SUFFIX
+
+# Deletion Reconciliation (tombstone or delete rows whose Magento record no longer exists)
+RECONCILE = config.RECONCILE
+RECONCILE_MODE = config.RECONCILE_MODE
+RECONCILE_PAGE_SIZE = config.RECONCILE_PAGE_SIZE
+
+# Dry-Run Planner and Budgets (estimate a run, skip or abort stores that would overrun their budgets)
+PLAN = config.PLAN
+PLAN_SLICE_DAYS = config.PLAN_SLICE_DAYS
+MAX_API_CALLS = config.MAX_API_CALLS
+MAX_API_CALLS_PER_HOUR = config.MAX_API_CALLS_PER_HOUR
+MAX_BQ_BYTES = config.MAX_BQ_BYTES
+
+# Raw Page Archive and Replay Mode (True to rebuild tables from the archive instead of calling Magento)
+ARCHIVE_DIR = config.ARCHIVE_DIR
+REPLAY = config.REPLAY
 
 # ----------------------------
 # ---    GET NEW M2 TOKEN ----
 # ----------------------------
 
 # Function to fetch data from Magento (with OTP)
-def get_magento_token():
+def get_magento_token(store):
     # Get OTP code from user
-    M2_OTP_CODE = input("Enter the current 6-digit OTP code from your Google Authenticator app: ")
+    M2_OTP_CODE = input(f"[{store['name']}] Enter the current 6-digit OTP code from your Google Authenticator app: ")
     
     # Prepare the payload for 2FA
     payload = {
-        "username": M2_USERNAME,
-        "password": M2_PASSWORD,
+        "username": store['username'],
+        "password": store['password'],
         "otp": M2_OTP_CODE
     }
 
     # Make the POST request to the 2FA authentication endpoint
-    response = requests.post(f"{M2_BASE_URL}/rest/V1/tfa/provider/google/authenticate", headers={"Content-Type": "application/json"}, data=json.dumps(payload))
+    response = SESSION.post(f"{store['base_url']}/rest/V1/tfa/provider/google/authenticate", headers={"Content-Type": "application/json"}, data=json.dumps(payload))
 
     # Check if the authentication is successful
     if response.status_code == 200:
@@ -64,42 +106,233 @@ def get_magento_token():
         return None
     
     
-M2_ACCESS_TOKEN = get_magento_token()
-
 # -------------------------------------------
-# ----- FETCH ORDER AND ITEM DETAILS --------
+# -------            STORES             -----
 # -------------------------------------------
 
-# Headers for authentication
-HEADERS = {
-    "Authorization": f"Bearer {M2_ACCESS_TOKEN}",
-    "Content-Type": "application/json"
-}
+# Shared HTTP connection pool, used by every store and worker.
+# Each fetch worker runs up to PAGE_WORKERS page requests at once, and load workers call Magento to reconcile
+SESSION = requests.Session()
+for prefix in ("https://", "http://"):
+    SESSION.mount(prefix, HTTPAdapter(pool_connections=max(len(STORES), 1), pool_maxsize=FETCH_WORKERS * PAGE_WORKERS + LOAD_WORKERS))
+
+# The store a worker thread is currently syncing
+_current_store = threading.local()
 
-def fetch_orders(from_date, to_date, page=1):
+def build_store(store_config):
     """
-    Fetches orders created between two dates.
-    Uses pagination to fetch results.
+    Builds the runtime state of a store from its entry in STORES.
+    Missing keys fall back to the single-store settings of config.py.
     """
-    url = (
-        f"{M2_BASE_URL}/rest/V1/orders?"
-        f"searchCriteria[filter_groups][0][filters][0][field]=created_at&"
-        f"searchCriteria[filter_groups][0][filters][0][value]={from_date} 00:00:00&"
-        f"searchCriteria[filter_groups][0][filters][0][condition_type]=from&"
-        f"searchCriteria[filter_groups][1][filters][0][field]=created_at&"
-        f"searchCriteria[filter_groups][1][filters][0][value]={to_date} 23:59:59&"
-        f"searchCriteria[filter_groups][1][filters][0][condition_type]=to&"
-        f"searchCriteria[pageSize]=50&"
-        f"searchCriteria[currentPage]={page}"
-    )
+    name = store_config.get("name", "default")
+    rate_limit = store_config.get("rate_limit", M2_RATE_LIMIT)
+    if MAX_API_CALLS_PER_HOUR is not None and rate_limit > MAX_API_CALLS_PER_HOUR / 3600:
+        print(f"[{name}] Throttling Magento requests to {MAX_API_CALLS_PER_HOUR} per hour.")
+        rate_limit = MAX_API_CALLS_PER_HOUR / 3600
+    rate_lock = threading.Lock()
+    return {
+        "name": name,
+        "base_url": store_config.get("base_url", M2_BASE_URL),
+        "access_token": store_config.get("access_token", M2_ACCESS_TOKEN),
+        "username": store_config.get("username", M2_USERNAME),
+        "password": store_config.get("password", M2_PASSWORD),
+        "dataset_id": store_config.get("dataset_id", BQ_DATASET_ID),
+        "rate_limit": rate_limit,
+        # Each store archives in its own sub-directory, the single store keeps the archive root
+        "archive_dir": os.path.join(ARCHIVE_DIR, name) if store_config else ARCHIVE_DIR,
+        "rate_lock": rate_lock,
+        # Signalled when a query releases its MAX_BQ_BYTES reservation
+        "bq_budget_free": threading.Condition(rate_lock),
+        "next_request_at": 0.0,
+        # Usage counted against MAX_API_CALLS and MAX_BQ_BYTES, not while the run is being planned
+        "api_calls": 0,
+        "bq_bytes": 0,
+        "bq_reserved": 0,
+        "planning": False,
+    }
 
-    response = requests.get(url, headers=HEADERS)
+def get_store():
+    return _current_store.store
 
-    if response.status_code == 200:
-        return response.json()
-    else:
-        print("Error fetching orders:", response.text)
-        return None
+def run_for_store(store, function, *args):
+    """
+    Runs a function with store as the current store of the calling worker thread.
+    """
+    _current_store.store = store
+    try:
+        return function(*args)
+    finally:
+        _current_store.store = None
+
+class BudgetExceededError(Exception):
+    pass
+
+def wait_for_rate_limit(store):
+    """
+    Blocks until the store's rate budget allows one more Magento request.
+    The slot is reserved under the lock, the wait itself happens outside of it.
+    Raises BudgetExceededError once the store has used up MAX_API_CALLS (planning requests are not counted).
+    """
+    with store['rate_lock']:
+        if not store['planning']:
+            if MAX_API_CALLS is not None and store['api_calls'] >= MAX_API_CALLS:
+                raise BudgetExceededError(f"[{store['name']}] MAX_API_CALLS ({MAX_API_CALLS}) reached.")
+            store['api_calls'] += 1
+        now = time.monotonic()
+        wait = store['next_request_at'] - now
+        store['next_request_at'] = max(now, store['next_request_at']) + 1 / store['rate_limit']
+    if wait > 0:
+        time.sleep(wait)
+
+def magento_get(path):
+    """
+    Sends a GET request to the Magento REST API of the current store,
+    through the shared HTTP session and within the store's rate budget.
+    Transient errors (429 and 5xx) are retried up to M2_MAX_RETRIES times, each retry counting as a request.
+    """
+    store = get_store()
+    headers = {
+        "Authorization": f"Bearer {store['access_token']}",
+        "Content-Type": "application/json"
+    }
+    for attempt in range(M2_MAX_RETRIES + 1):
+        wait_for_rate_limit(store)
+        response = SESSION.get(f"{store['base_url']}/rest/V1/{path}", headers=headers)
+        if (response.status_code != 429 and response.status_code < 500) or attempt == M2_MAX_RETRIES:
+            return response
+
+        # Back off before retrying: Retry-After when Magento sends it, otherwise 1s, 2s, 4s, ...
+        retry_after = response.headers.get("Retry-After", "")
+        delay = int(retry_after) if retry_after.isdigit() else 2 ** attempt
+        print(f"[{store['name']}] Magento returned {response.status_code}, retrying in {delay}s...")
+        time.sleep(delay)
+
+def bq_table_ref(table_id):
+    """
+    Returns the full ID of a table in the current store's dataset.
+    """
+    return f"{BQ_PROJECT_ID}.{get_store()['dataset_id']}.{table_id}"
+
+def run_query(query, job_config=None):
+    """
+    Runs a BigQuery query for the current store and waits for it to complete.
+    With MAX_BQ_BYTES, the query reserves the store's remaining budget and may only bill that much
+    (the store's other queries wait for the reservation), and the bytes it billed are counted.
+    Raises BudgetExceededError when the budget is used up or the query would go over it.
+    """
+    store = get_store()
+    job_config = job_config or bigquery.QueryJobConfig()
+    if MAX_BQ_BYTES is not None:
+        with store['rate_lock']:
+            store['bq_budget_free'].wait_for(lambda: not store['bq_reserved'])
+            remaining_bytes = MAX_BQ_BYTES - store['bq_bytes']
+            if remaining_bytes <= 0:
+                raise BudgetExceededError(f"[{store['name']}] MAX_BQ_BYTES ({MAX_BQ_BYTES}) reached.")
+            store['bq_reserved'] = remaining_bytes
+        job_config.maximum_bytes_billed = remaining_bytes
+
+    billed_bytes = 0
+    try:
+        query_job = client.query(query, job_config=job_config)
+        query_job.result()
+        billed_bytes = query_job.total_bytes_billed or 0
+    except Exception as e:
+        # BigQuery refuses a query over maximum_bytes_billed with its own error, abort the store like any overrun
+        if any(error.get('reason') == 'bytesBilledLimitExceeded' for error in getattr(e, 'errors', None) or []):
+            raise BudgetExceededError(f"[{store['name']}] MAX_BQ_BYTES ({MAX_BQ_BYTES}) reached: {str(e)}") from e
+        raise
+    finally:
+        with store['rate_lock']:
+            store['bq_bytes'] += billed_bytes
+            store['bq_reserved'] = 0
+            store['bq_budget_free'].notify_all()
+    return query_job
+
+stores = [build_store(store_config) for store_config in STORES] or [build_store({})]
+
+# Replay runs only read the local archive, so no Magento token is needed
+if REPLAY != "True":
+    for store in stores:
+        if not store['access_token']:
+            store['access_token'] = get_magento_token(store)
+
+# -------------------------------------------
+# -------      RAW PAGE ARCHIVE         -----
+# -------------------------------------------
+
+def archive_page(entity, page_data, date_field):
+    """
+    Stores the raw items of a fetched Magento page in the local archive.
+    Items are split by entity and by the date in date_field, one gzip JSON lines file per partition,
+    so a replay only has to read the partitions inside its date range.
+    """
+    partitions = {}
+    # Snapshot entities (no date field) are partitioned by the date they were fetched
+    fetch_date = time.strftime("%Y-%m-%d")
+    for item in page_data.get('items', []):
+        item_date = ((item.get(date_field) if date_field else fetch_date) or 'unknown').split('T')[0].split(' ')[0]
+        partitions.setdefault(item_date, []).append(item)
+
+    for item_date, items in partitions.items():
+        partition_dir = os.path.join(get_store()['archive_dir'], entity, f"date={item_date}")
+        os.makedirs(partition_dir, exist_ok=True)
+        # Each append adds a new gzip member, gzip readers concatenate them transparently
+        with gzip.open(os.path.join(partition_dir, "pages.jsonl.gz"), "at", encoding="utf-8") as f:
+            for item in items:
+                f.write(json.dumps(item) + "\n")
+
+def item_key(item, id_field):
+    """
+    Returns the primary key of a raw Magento item (a tuple for composite keys).
+    """
+    return tuple(item.get(field) for field in id_field) if isinstance(id_field, list) else item.get(id_field)
+
+def load_archived_pages(entity, from_date, to_date, id_field, page_size=1000):
+    """
+    Reads the archived items of an entity between two dates (inclusive) and returns them
+    as Magento-shaped pages ({'items': [...]}) so they go through the usual formatters.
+    Items archived more than once are de-duplicated on id_field (a list of fields for composite keys),
+    keeping the latest copy across the whole archive: an item updated again after to_date is left out,
+    like a live fetch of the range would, instead of replaying an older copy over the newer row.
+    """
+    entity_dir = os.path.join(get_store()['archive_dir'], entity)
+    if not os.path.isdir(entity_dir):
+        print(f"No archive found for {entity} in {entity_dir}.")
+        return []
+
+    # Partitions are read in date order and appended in fetch order, so the last copy read is the latest
+    items_by_id = {}
+    for partition in sorted(os.listdir(entity_dir)):
+        item_date = partition.split('=', 1)[-1]
+        with gzip.open(os.path.join(entity_dir, partition, "pages.jsonl.gz"), "rt", encoding="utf-8") as f:
+            for line in f:
+                item = json.loads(line)
+                items_by_id[item_key(item, id_field)] = (item_date, item)
+
+    items = [item for item_date, item in items_by_id.values() if from_date <= item_date <= to_date]
+    print(f"Loaded {len(items)} archived {entity} for {from_date} to {to_date}.")
+    return [{'items': items[i:i + page_size]} for i in range(0, len(items), page_size)]
+
+def archive_lookup(name, data=None):
+    """
+    Stores (when data is given) or reads back a small lookup table such as the customer groups.
+    """
+    archive_dir = get_store()['archive_dir']
+    path = os.path.join(archive_dir, f"{name}.json")
+    if data is not None:
+        os.makedirs(archive_dir, exist_ok=True)
+        with open(path, "w", encoding="utf-8") as f:
+            json.dump(data, f)
+        return data
+    if not os.path.exists(path):
+        print(f"No archived {name} found in {path}.")
+        return {}
+    with open(path, encoding="utf-8") as f:
+        return json.load(f)
+
+# -------------------------------------------
+# ------- FORMAT ORDER AND ITEM DETAILS -----
+# -------------------------------------------
 
 def format_order_data(orders_data):
     """
@@ -146,73 +379,24 @@ def format_order_data(orders_data):
                 "Total_Item_Price": f"{item.get('row_total')} {currency}",
             })
 
-    return pd.DataFrame(formatted_data)
-
-def fetch_all_orders(from_date, to_date):
-    """
-    Fetches all orders between a given date range in an iterative way.
-    It checks the last date from the fetched orders and continues until all orders are retrieved.
-    """
-    all_orders_data = []
-    current_date = from_date
-    page = 1
-    while True:
-        print(f"Fetching orders for {current_date} (page {page})...")
-        orders_data = fetch_orders(current_date, to_date, page)
-        
-        if not orders_data or not orders_data.get('items'):
-            print("No more orders found.")
-            break
-
-        all_orders_data.append(orders_data)
-        # Check the last order date from the current batch of orders to adjust the current_date
-        last_order_date = orders_data['items'][-1]['created_at']
-        current_date = last_order_date.split('T')[0]  # Date part of the last order date
-        
-        page += 1
-        time.sleep(1)
-
-    # Combine all fetched data into a single DataFrame
-    all_formatted_data = []
-    for orders_data in all_orders_data:
-        all_formatted_data.append(format_order_data(orders_data))
-    
-    return pd.concat(all_formatted_data, ignore_index=True) if all_formatted_data else pd.DataFrame()
+    return optimize_dtypes(pd.DataFrame(formatted_data), CATEGORICAL_COLUMNS.get(BQ_ORDER_TABLE_ID, []))
 
 # -------------------------------------------
-# -------       FETCH CUSTOMER DATA     -----
+# -------     FORMAT CUSTOMER DATA      -----
 # -------------------------------------------
 
-def fetch_customers(from_date, to_date, page=1):
-    url = (
-        f"{M2_BASE_URL}/rest/V1/customers/search?"
-        f"searchCriteria[filter_groups][0][filters][0][field]=updated_at&"
-        f"searchCriteria[filter_groups][0][filters][0][value]={from_date} 00:00:00&"
-        f"searchCriteria[filter_groups][0][filters][0][condition_type]=from&"
-        f"searchCriteria[filter_groups][1][filters][0][field]=updated_at&"
-        f"searchCriteria[filter_groups][1][filters][0][value]={to_date} 23:59:59&"
-        f"searchCriteria[filter_groups][1][filters][0][condition_type]=to&"
-        f"searchCriteria[pageSize]=50&"
-        f"searchCriteria[currentPage]={page}"
-    )
-
-    response = requests.get(url, headers=HEADERS)
-
-    if response.status_code == 200:
-        return response.json()
-    else:
-        print(f"Error fetching customers: {response.text}")
-        return None
-
 def fetch_all_customer_groups():
     """
     Fetch all customer groups at once and return as a dictionary mapping ID to name
     """
+    if REPLAY == "True":
+        # JSON object keys are strings, restore the integer group IDs used by Magento
+        return {int(group_id): code for group_id, code in archive_lookup('customer_groups').items()}
+
     groups_dict = {}
     try:
         print("Fetching all customer groups...")
-        url = f"{M2_BASE_URL}/rest/V1/customerGroups/search?searchCriteria[pageSize]=100"
-        response = requests.get(url, headers=HEADERS)
+        response = magento_get("customerGroups/search?searchCriteria[pageSize]=100")
         
         if response.status_code == 200:
             groups_data = response.json()
@@ -221,7 +405,7 @@ def fetch_all_customer_groups():
                 group_code = group.get('code')
                 groups_dict[group_id] = group_code
             print(f"Successfully fetched {len(groups_dict)} customer groups")
-            return groups_dict
+            return archive_lookup('customer_groups', groups_dict)
         else:
             print(f"Error fetching customer groups: {response.text}")
             return {}
@@ -351,69 +535,159 @@ def format_customer_data(customers_data, customer_groups):
             "Company": custom_attributes.get('company', ''),
             "Account_Status": custom_attributes.get('customer_activation', '1'),  # '1' typically means active
             "Total_Address_Count": len(addresses),
-            "Account_Age_Days": None,  # This will be calculated later if needed
+            # Account_Age_Days is a derived column, computed in the customers view (see DERIVED_COLUMNS)
         })
 
     print(f"Completed formatting {customer_count} customers")
-    return pd.DataFrame(formatted_data)
+    return optimize_dtypes(pd.DataFrame(formatted_data), CATEGORICAL_COLUMNS.get(BQ_CUSTOMER_TABLE_ID, []))
 
-def fetch_all_customers(from_date, to_date):
-    all_customers_data = []
-    page = 1
-    total_pages = 1
-    
-    while page <= total_pages:
-        print(f"Fetching customers for date range {from_date} to {to_date} (page {page})...")
-        customers_data = fetch_customers(from_date, to_date, page)
-        
-        if not customers_data or not customers_data.get('items'):
-            print("No customers found for the specified date range.")
-            break
+# -------------------------------------------
+# -------        ENTITY ENGINE          -----
+# -------------------------------------------
 
-        all_customers_data.append(customers_data)
-        
-        # Update total pages based on search criteria
-        total_count = customers_data.get('total_count', 0)
-        page_size = 100  # This should match the pageSize in the API call
-        total_pages = (total_count + page_size - 1) // page_size
-        
-        print(f"Retrieved page {page} of {total_pages} (Total customers: {total_count})")
-        page += 1
-        time.sleep(1)  # To avoid hitting API rate limits
+# Hand-written formatters, for entities that need more than a column mapping (built once per fetch)
+CUSTOM_FORMATTERS = {
+    'orders': lambda: format_order_data,
+    'customers': lambda: partial(format_customer_data, customer_groups=fetch_all_customer_groups()),
+}
 
-    print("All customer data fetched, beginning processing...")
-    
-    # Fetch all customer groups once (major performance improvement)
-    customer_groups = fetch_all_customer_groups()
-
-    # Combine all fetched data into a single DataFrame
-    all_formatted_data = []
-    for i, customers_data in enumerate(all_customers_data):
-        print(f"Processing batch {i+1}/{len(all_customers_data)}...")
-        all_formatted_data.append(format_customer_data(customers_data, customer_groups))
-    
-    df_customers = pd.concat(all_formatted_data, ignore_index=True) if all_formatted_data else pd.DataFrame()
+def get_field(item, field):
+    """
+    Returns a field of a Magento item, "a.b" for nested fields and a list of fields to join them with ":".
+    """
+    if isinstance(field, list):
+        return ":".join(str(get_field(item, part)) for part in field)
+    value = item
+    for key in field.split('.'):
+        value = value.get(key) if isinstance(value, dict) else None
+    return value
+
+def format_entity_data(entity_data, spec):
+    """
+    Formats a page of any entity into a structured dataframe, following the columns mapping of its spec.
+    """
+    formatted_data = [
+        {col: get_field(item, field) for col, field in spec['columns'].items()}
+        for item in entity_data.get('items', [])
+    ]
+    return optimize_dtypes(pd.DataFrame(formatted_data, columns=list(spec['columns'])), CATEGORICAL_COLUMNS.get(spec['table_id'], []))
 
-    print(f"Customer data formatted, processing {len(df_customers)} records...")
+def build_search_url(spec, from_date, to_date, page, page_size):
+    """
+    Builds the search URL of a page of an entity, with its date filter, sort order and projected fields.
+    """
+    url = f"{spec['endpoint']}?"
+    if spec['filter_field']:
+        url += (
+            f"searchCriteria[filter_groups][0][filters][0][field]={spec['filter_field']}&"
+            f"searchCriteria[filter_groups][0][filters][0][value]={from_date} 00:00:00&"
+            f"searchCriteria[filter_groups][0][filters][0][condition_type]=from&"
+            f"searchCriteria[filter_groups][1][filters][0][field]={spec['filter_field']}&"
+            f"searchCriteria[filter_groups][1][filters][0][value]={to_date} 23:59:59&"
+            f"searchCriteria[filter_groups][1][filters][0][condition_type]=to&"
+        )
+    # Cursor timestamps tie often (bulk imports, mass updates) and MySQL does not keep the order of ties
+    # across LIMIT/OFFSET queries, so the unique ID field(s) always break ties for a total order
+    id_fields = spec['id_field'] if isinstance(spec['id_field'], list) else [spec['id_field']]
+    sort_fields = ([spec['cursor_field']] if spec['cursor_field'] else []) + id_fields
+    for i, sort_field in enumerate(sort_fields):
+        url += (
+            f"searchCriteria[sortOrders][{i}][field]={sort_field}&"
+            f"searchCriteria[sortOrders][{i}][direction]=ASC&"
+        )
+    url += (
+        f"searchCriteria[pageSize]={page_size}&"
+        f"searchCriteria[currentPage]={page}"
+    )
+    if spec.get('fields'):
+        url += f"&fields=items[{spec['fields']}],total_count"
+    return url
+
+def fetch_entity_page(entity, spec, from_date, to_date, page):
+    response = magento_get(build_search_url(spec, from_date, to_date, page, spec['page_size']))
+
+    if response.status_code == 200:
+        return response.json()
+    else:
+        print(f"Error fetching {entity} (page {page}): {response.text}")
+        return None
+
+def fetch_entity(entity, from_date, to_date):
+    """
+    Fetches all the data of an entity between two dates, following its spec in ENTITIES.
+    The first page gives the total count, the other pages are then fetched concurrently.
+    Each page is archived and formatted as soon as it arrives, so raw pages are never all held in memory.
+    Records returned on more than one page (the collection changed during the fetch) are kept once.
+    """
+    spec = ENTITIES[entity]
+    formatter = CUSTOM_FORMATTERS[spec['formatter']]() if spec.get('formatter') else partial(format_entity_data, spec=spec)
+
+    if REPLAY == "True":
+        print(f"Replaying {entity} from archive for {from_date} to {to_date}...")
+        pages = load_archived_pages(entity, from_date, to_date, spec['id_field'])
+        return concat_frames([formatter(entity_data) for entity_data in pages])
+
+    print(f"Fetching {entity} for date range {from_date} to {to_date} (page 1)...")
+    entity_data = fetch_entity_page(entity, spec, from_date, to_date, 1)
+    if entity_data is None:
+        raise RuntimeError(f"Could not fetch {entity} page 1.")
+    if not entity_data.get('items'):
+        print(f"No {entity} found for the specified date range.")
+        return pd.DataFrame()
+
+    total_count = entity_data.get('total_count', 0)
+    total_pages = (total_count + spec['page_size'] - 1) // spec['page_size']
+    print(f"Retrieved page 1 of {total_pages} (Total {entity}: {total_count})")
+
+    seen_ids = set()
+    duplicates = 0
+
+    def drop_seen_items(entity_data):
+        nonlocal duplicates
+        items = []
+        for item in entity_data.get('items') or []:
+            item_id = item_key(item, spec['id_field'])
+            if item_id in seen_ids:
+                duplicates += 1
+                continue
+            seen_ids.add(item_id)
+            items.append(item)
+        return {**entity_data, 'items': items}
+
+    entity_data = drop_seen_items(entity_data)
+    archive_page(entity, entity_data, spec['cursor_field'])
+    formatted_data = [formatter(entity_data)]
+
+    store = get_store()
+    with ThreadPoolExecutor(max_workers=PAGE_WORKERS) as page_pool:
+        futures = {
+            page_pool.submit(run_for_store, store, fetch_entity_page, entity, spec, from_date, to_date, page): page
+            for page in range(2, total_pages + 1)
+        }
+        for future in as_completed(futures):
+            entity_data = future.result()
+            # A missing page would make a reset or reconciliation drop real data, so never load partial results.
+            # The pages still queued are cancelled, they would only spend the store's request budget.
+            if entity_data is None:
+                page_pool.shutdown(cancel_futures=True)
+                raise RuntimeError(f"Could not fetch {entity} page {futures[future]} of {total_pages}.")
+
+            entity_data = drop_seen_items(entity_data)
+            archive_page(entity, entity_data, spec['cursor_field'])
+            formatted_data.append(formatter(entity_data))
+            print(f"Retrieved page {futures[future]} of {total_pages}")
+
+    if duplicates:
+        print(f"Dropped {duplicates} {entity} returned on more than one page.")
+    if len(seen_ids) < total_count:
+        # Records edited during the fetch move to a later page and can be skipped by the offset pagination.
+        # A reset would swap the shorter data set into the live table, an incremental run picks them up next time.
+        message = f"fetched {len(seen_ids)} unique {entity} out of {total_count}, the collection changed during the fetch."
+        if RESET == "True":
+            raise RuntimeError(f"Could not fetch every {entity}: {message}")
+        print(f"Warning: {message}")
+    return concat_frames(formatted_data)
 
-    # Calculate account age if created_at exists
-    if not df_customers.empty and 'Created_At' in df_customers.columns:
-        try:
-            print("Calculating account age...")
-            # Convert string dates to datetime objects
-            df_customers['Created_At_DT'] = pd.to_datetime(df_customers['Created_At'])
-            current_time = pd.Timestamp.now()
-            
-            # Calculate account age in days
-            df_customers['Account_Age_Days'] = (current_time - df_customers['Created_At_DT']).dt.days
-            
-            # Drop the temporary datetime column
-            df_customers = df_customers.drop(columns=['Created_At_DT'])
-            print("Account age calculation completed")
-        except Exception as e:
-            print(f"Warning: Could not calculate account age: {str(e)}")
-    
-    return df_customers
 # -------------------------------------------
 # -------          ETL FUNCTIONS        -----
 # -------------------------------------------
@@ -422,7 +696,7 @@ def fetch_all_customers(from_date, to_date):
 def check_table_exists(table_id):
     try:
         # Try fetching the table to check if it exists
-        table = client.get_table(f"{BQ_PROJECT_ID}.{BQ_DATASET_ID}.{table_id}")
+        table = client.get_table(bq_table_ref(table_id))
         print(f"Table {table_id} exists.")
         return table
     except Exception as e:
@@ -436,10 +710,17 @@ def check_table_exists(table_id):
             raise
     
 
+def existing_data_query(table_id):
+    return f"""
+            SELECT *
+            FROM `{bq_table_ref(table_id)}`
+        """
+
+
 def fetch_existing_data_from_bq(table_id):
     try:
         # Check if the table has a schema by getting table metadata
-        table_ref = f"{BQ_PROJECT_ID}.{BQ_DATASET_ID}.{table_id}"
+        table_ref = bq_table_ref(table_id)
         table = client.get_table(table_ref)
         
         # If table has no schema, return an empty DataFrame
@@ -447,14 +728,9 @@ def fetch_existing_data_from_bq(table_id):
             print(f"Table {table_id} exists but has no schema. Returning empty DataFrame.")
             return pd.DataFrame()
         
-        # If table exists and has a schema, query the data
-        query = f"""
-            SELECT *
-            FROM `{BQ_PROJECT_ID}.{BQ_DATASET_ID}.{table_id}`
-        """
-        query_job = client.query(query)
-        df_existing = query_job.to_dataframe()
-        return df_existing
+        # If table exists and has a schema, query the data (read through Arrow to keep the compact dtypes)
+        query_job = run_query(existing_data_query(table_id))
+        return arrow_to_frame(query_job.to_arrow(), CATEGORICAL_COLUMNS.get(table_id, []))
     
     except Exception as e:
         # If the error is due to no schema, return an empty DataFrame
@@ -482,36 +758,98 @@ def create_table_from_data(table_id, df_new):
     # Check if the table exists, and delete it before recreating
     try:
         # Check if table exists
-        client.get_table(f"{BQ_PROJECT_ID}.{BQ_DATASET_ID}.{table_id}")
+        client.get_table(bq_table_ref(table_id))
         print(f"Table {table_id} already exists. Deleting the table.")
-        client.delete_table(f"{BQ_PROJECT_ID}.{BQ_DATASET_ID}.{table_id}")  # Delete the table
+        client.delete_table(bq_table_ref(table_id))  # Delete the table
     except bigquery.exceptions.NotFound:
         print(f"Table {table_id} does not exist. Proceeding to create a new one.")
     
     # Recreate the table with the new schema
-    table = bigquery.Table(f"{BQ_PROJECT_ID}.{BQ_DATASET_ID}.{table_id}", schema=schema)
+    table = bigquery.Table(bq_table_ref(table_id), schema=schema)
     client.create_table(table)  # Create the table with the inferred schema
     print(f"Table {table_id} has been created with schema from Magento data.")
     return df_new
 
 
 
-def reset_bigquery_table(table_id):
-    print(f"Resetting data and schema in BigQuery table {table_id}...")
-    
-    # Step 1: Delete the table (this removes all data and schema)
-    client.delete_table(f"{BQ_PROJECT_ID}.{BQ_DATASET_ID}.{table_id}", not_found_ok=True)
-    print(f"Table {table_id} has been deleted.")
-    
-    # Step 2: Recreate the table with an empty schema
-    schema = []  # Empty schema
-    table = bigquery.Table(f"{BQ_PROJECT_ID}.{BQ_DATASET_ID}.{table_id}", schema=schema)
-    client.create_table(table)  # Recreate the table
-    print(f"Table {table_id} has been recreated with a new schema.")
+def build_shadow_table(table_id, df_new):
+    """
+    Bulk loads the full data of a reset run into the shadow table of table_id, with the final schema.
+    The live table is not touched, so it stays available while the shadow table is built.
+    """
+    shadow_ref = f"{bq_table_ref(table_id)}{BQ_SHADOW_SUFFIX}"
+    print(f"Loading {len(df_new)} records into shadow table {table_id}{BQ_SHADOW_SUFFIX}...")
+
+    job_config = bigquery.LoadJobConfig(
+        schema=[bigquery.SchemaField(col, "STRING") for col in df_new.columns],
+        write_disposition=bigquery.WriteDisposition.WRITE_TRUNCATE,
+    )
+    client.load_table_from_dataframe(df_new, shadow_ref, job_config=job_config).result()
+    print(f"Shadow table {table_id}{BQ_SHADOW_SUFFIX} has been built.")
+    return shadow_ref
+
+
+def swap_shadow_table(table_id, shadow_ref):
+    """
+    Atomically replaces the live table (data and schema) with its shadow table,
+    using a copy job with WRITE_TRUNCATE, then drops the shadow table.
+    """
+    table_ref = bq_table_ref(table_id)
+    print(f"Swapping shadow table into {table_id}...")
+
+    job_config = bigquery.CopyJobConfig(write_disposition=bigquery.WriteDisposition.WRITE_TRUNCATE)
+    client.copy_table(shadow_ref, table_ref, job_config=job_config).result()
+    client.delete_table(shadow_ref, not_found_ok=True)
+    print(f"Table {table_id} has been replaced with the rebuilt data.")
+
+
+def create_derived_view(table_id):
+    """
+    Creates (or replaces) the view exposing the base table plus its derived columns.
+    Derived columns are volatile values such as Account_Age_Days, they are computed at query time
+    so the base table only changes when the data in Magento changes.
+    """
+    derived_columns = DERIVED_COLUMNS.get(table_id, {})
+    if not derived_columns:
+        return
+
+    table_ref = bq_table_ref(table_id)
+    view_ref = f"{table_ref}{BQ_VIEW_SUFFIX}"
+
+    # Drop stored copies of the derived columns left over from earlier loads
+    stored_columns = [field.name for field in client.get_table(table_ref).schema]
+    for col in derived_columns:
+        if col in stored_columns:
+            print(f"Dropping stored derived column {col} from table {table_id}...")
+            run_query(f"ALTER TABLE `{table_ref}` DROP COLUMN {col}")
+
+    select_derived = ",\n            ".join(f"{expression} AS {col}" for col, expression in derived_columns.items())
+    query = f"""
+        CREATE OR REPLACE VIEW `{view_ref}` AS
+        SELECT
+            *,
+            {select_derived}
+        FROM `{table_ref}`
+    """
+    run_query(query)
+    print(f"View {table_id}{BQ_VIEW_SUFFIX} is up to date with derived columns: {', '.join(derived_columns)}.")
+
+
+def values_differ(old_values, new_values):
+    """
+    Compares two columns value by value. Every BigQuery column is a STRING, so both sides
+    are compared as strings, with missing values treated as empty strings.
+    """
+    return old_values.astype(STRING_DTYPE).fillna("") != new_values.astype(STRING_DTYPE).fillna("")
     
 
 # Compare and update the data in BQ table
-def compare_and_update_data(df_new, df_existing, id_column):
+def compare_and_update_data(df_new, df_existing, id_column, exclude_columns=()):
+    # Derived/volatile columns are never compared, drop them from the existing data
+    excluded_columns = [col for col in exclude_columns if col in df_existing.columns]
+    if excluded_columns:
+        df_existing = df_existing.drop(columns=excluded_columns)
+
     # Check if the DataFrames are empty
     if df_new.empty:
         print(f"No new data provided. Skipping comparison.")
@@ -522,75 +860,46 @@ def compare_and_update_data(df_new, df_existing, id_column):
         print(f"Error: '{id_column}' column not found in new data. Available columns: {df_new.columns.tolist()}")
         return pd.DataFrame(), pd.DataFrame()
     
+    # Both frames are owned by the pipeline, so the ID columns are aligned in place (no frame copies).
+    # The formatters already produce Arrow-backed strings, making this a no-op in the normal flow.
+    df_new[id_column] = df_new[id_column].astype(STRING_DTYPE)
+    
     if df_existing.empty:
         print(f"No existing data found. All new data will be treated as new records.")
-        # Create a DataFrame with the same structure as df_new but empty
-        df_empty = pd.DataFrame(columns=df_new.columns)
-        # Ensure consistent data types for the merge
-        if id_column in df_empty.columns:
-            df_empty[id_column] = df_empty[id_column].astype(str)
-        df_new[id_column] = df_new[id_column].astype(str)
-        # Perform outer merge to identify new records
-        df_combined = pd.merge(df_empty, df_new, on=id_column, how="outer", suffixes=("_old", "_new"), indicator=True)
-        return df_combined[df_combined["_merge"] == "right_only"], pd.DataFrame()
+        return df_new, pd.DataFrame()
     
     if id_column not in df_existing.columns:
         print(f"Error: '{id_column}' column not found in existing data. Available columns: {df_existing.columns.tolist()}")
         print("Treating all new data as new records.")
-        # Create a new DataFrame with just the id_column
-        df_empty = pd.DataFrame({id_column: []})
-        df_empty[id_column] = df_empty[id_column].astype(str)
-        df_new[id_column] = df_new[id_column].astype(str)
-        df_combined = pd.merge(df_empty, df_new, on=id_column, how="outer", suffixes=("_old", "_new"), indicator=True)
-        return df_combined[df_combined["_merge"] == "right_only"], pd.DataFrame()
+        return df_new, pd.DataFrame()
     
-    # Print the data types for debugging
-    print(f"Data type of {id_column} in new data: {df_new[id_column].dtype}")
-    print(f"Data type of {id_column} in existing data: {df_existing[id_column].dtype}")
+    df_existing[id_column] = df_existing[id_column].astype(STRING_DTYPE)
     
-    # Convert both DataFrames' ID columns to the same type (string)
-    df_new = df_new.copy()
-    df_existing = df_existing.copy()
+    # New records are taken straight from df_new, so they keep its columns and dtypes
+    is_existing = df_new[id_column].isin(df_existing[id_column])
+    new_records = df_new[~is_existing]
     
-    df_new[id_column] = df_new[id_column].astype(str)
-    df_existing[id_column] = df_existing[id_column].astype(str)
-    
-    # Print the data types after conversion
-    print(f"After conversion - Data type of {id_column} in new data: {df_new[id_column].dtype}")
-    print(f"After conversion - Data type of {id_column} in existing data: {df_existing[id_column].dtype}")
-    
-    # Now perform the merge with consistent data types
-    df_combined = pd.merge(df_existing, df_new, on=id_column, how="outer", suffixes=("_old", "_new"), indicator=True)
-    
-    # Find new and updated records
-    new_records = df_combined[df_combined["_merge"] == "right_only"]
-    updated_records = df_combined[df_combined["_merge"] == "both"]
+    # Only records present on both sides need to be merged for comparison
+    updated_records = pd.merge(df_existing, df_new[is_existing], on=id_column, how="inner", suffixes=("_old", "_new"))
     
     # Check for actual differences in content between old and new versions
-    # Get all columns except the ID column and "_merge" indicator
-    value_columns = [col for col in updated_records.columns 
-                    if not col.endswith('_old') and not col.endswith('_new') 
-                    and col != '_merge' and col != id_column]
+    # Get every column present on both sides (suffixed by the merge), except the excluded ones
+    value_columns = [col[:-len('_new')] for col in updated_records.columns
+                    if col.endswith('_new') and f"{col[:-len('_new')]}_old" in updated_records.columns
+                    and col[:-len('_new')] not in exclude_columns]
     
-    # For each value column, check if old and new values are different
-    has_changes = False
+    # Flag the rows where at least one value column differs between old and new
+    has_changes = pd.Series(False, index=updated_records.index)
     for col in value_columns:
-        old_col = f"{col}_old"
-        new_col = f"{col}_new"
-        
-        if old_col in updated_records.columns and new_col in updated_records.columns:
-            # Check if any row has different values between old and new
-            has_diff = (updated_records[old_col] != updated_records[new_col]).any()
-            if has_diff:
-                has_changes = True
-                break
+        has_changes |= values_differ(updated_records[f"{col}_old"], updated_records[f"{col}_new"])
     
-    # If no actual changes found, return empty DataFrame for updated_records
-    if not has_changes:
+    # Keep only rows where there are actual differences
+    if not has_changes.any():
         updated_records = pd.DataFrame()
     else:
-        # Keep only rows where there are actual differences
-        updated_records = updated_records[updated_records.filter(like="_new").ne(updated_records.filter(like="_old")).any(axis=1)]
+        # A non-unique key (one order row per item) pairs every existing row with every new row of the ID,
+        # but each MERGE writes all the rows of its ID and the last one wins: keep that one, one MERGE per ID
+        updated_records = updated_records[has_changes].drop_duplicates(subset=id_column, keep="last")
     
     return new_records, updated_records
 
@@ -601,14 +910,41 @@ def upload_to_bq(df_new, table_id):
     cols_to_drop = [col for col in df_new.columns if col.endswith('_old') or col.endswith('_new') or col == '_merge']
     df_new = df_new.drop(columns=cols_to_drop)
     
-    # Generate the full table ID
-    table_full_id = f"{BQ_PROJECT_ID}.{BQ_DATASET_ID}.{table_id}"
+    # The load schema is the table's own: its columns the new records do not have
+    # (a Deleted_At tombstone column, a stored derived column) are loaded as NULLs
+    table_schema = client.get_table(bq_table_ref(table_id)).schema
+    for field in table_schema:
+        if field.name not in df_new.columns:
+            df_new[field.name] = pd.Series(pd.NA, index=df_new.index, dtype=STRING_DTYPE)
     
-    # Upload to BigQuery
-    pandas_gbq.to_gbq(df_new, destination_table=table_full_id, project_id=BQ_PROJECT_ID, if_exists='append')
+    # Upload to BigQuery with a load job on the shared client
+    job_config = bigquery.LoadJobConfig(
+        schema=table_schema,
+        write_disposition=bigquery.WriteDisposition.WRITE_APPEND,
+    )
+    client.load_table_from_dataframe(df_new, bq_table_ref(table_id), job_config=job_config).result()
     print(f'New records uploaded successfully to table {table_id}!')
    
    
+def merge_query(table_id, id_column, set_clause, insert_columns, insert_values):
+    # The record ID is passed as the @id query parameter (see merge_parameters), never inlined in the SQL
+    return f"""
+        MERGE `{bq_table_ref(table_id)}` AS T
+        USING (SELECT @id AS id) AS S
+        ON T.{id_column} = S.id
+        WHEN MATCHED THEN
+            UPDATE SET
+                {', '.join(set_clause)}
+        WHEN NOT MATCHED THEN
+            INSERT ({', '.join(insert_columns)}) 
+            VALUES ({', '.join(insert_values)});
+        """
+
+
+def merge_parameters(id_value):
+    return [bigquery.ScalarQueryParameter("id", "STRING", str(id_value))]
+
+
 def update_existing_data_in_bq(df_updated, table_id, id_column):
     print(f"Starting to update {len(df_updated)} records in {table_id}...")
 
@@ -627,7 +963,7 @@ def update_existing_data_in_bq(df_updated, table_id, id_column):
         # Initialize the lists to hold query clauses
         set_clause = []
         insert_columns = [id_column]  # Always insert the ID column
-        insert_values = [f"'{row[id_column]}'"]
+        insert_values = ["S.id"]
 
         # Loop over all columns in the row and check for '_new' versions first
         for col in row.keys():
@@ -644,7 +980,7 @@ def update_existing_data_in_bq(df_updated, table_id, id_column):
                 # Add SET clause to update the column in BigQuery
                 # Use appropriate formatting and escaping for the value
                 value = row[col]
-                if value is not None:
+                if not pd.isna(value):
                     # Escape single quotes in string values
                     if isinstance(value, str):
                         value = value.replace("'", "''")
@@ -663,50 +999,298 @@ def update_existing_data_in_bq(df_updated, table_id, id_column):
             continue  # Skip if no changes detected
         
         # Construct the query with dynamic SET clause
-        query = f"""
-        MERGE `{BQ_PROJECT_ID}.{BQ_DATASET_ID}.{table_id}` AS T
-        USING (SELECT '{row[id_column]}' AS id) AS S
-        ON T.{id_column} = S.id
-        WHEN MATCHED THEN
-            UPDATE SET
-                {', '.join(set_clause)}
-        WHEN NOT MATCHED THEN
-            INSERT ({', '.join(insert_columns)}) 
-            VALUES ({', '.join(insert_values)});
-        """
+        query = merge_query(table_id, id_column, set_clause, insert_columns, insert_values)
+        job_config = bigquery.QueryJobConfig(query_parameters=merge_parameters(row[id_column]))
 
         # Execute the query to update BigQuery
         try:
-            client.query(query).result()  # Execute the query and wait for the result
+            run_query(query, job_config=job_config)  # Execute the query and wait for the result
             print(f'Updated {id_column} {row[id_column]} in BigQuery table {table_id}.')
+        except BudgetExceededError:
+            raise
         except Exception as e:
             print(f"Error updating {id_column} {row[id_column]}: {str(e)}")
 
 # -------------------------------------------
-# -------         MAIN FUNCTION         -----
+# -------    DELETION RECONCILIATION    -----
 # -------------------------------------------
 
+def fetch_magento_ids(endpoint, id_field):
+    """
+    Fetches every ID of an entity from Magento, asking only for the ID field of each item.
+    Pages are read by keyset (IDs sorted ascending, each page starting after the last ID seen),
+    so no ID is skipped or repeated when records are added or deleted during the scan.
+    Returns a sorted int64 array of unique IDs, or None if any page could not be fetched.
+    """
+    ids = []
+    last_id = 0
+    page = 1
+    while True:
+        url = (
+            f"{endpoint}?"
+            f"searchCriteria[filter_groups][0][filters][0][field]={id_field}&"
+            f"searchCriteria[filter_groups][0][filters][0][value]={last_id}&"
+            f"searchCriteria[filter_groups][0][filters][0][condition_type]=gt&"
+            f"searchCriteria[sortOrders][0][field]={id_field}&"
+            f"searchCriteria[sortOrders][0][direction]=ASC&"
+            f"searchCriteria[pageSize]={RECONCILE_PAGE_SIZE}&"
+            f"searchCriteria[currentPage]=1&"
+            f"fields=items[{id_field}]"
+        )
+        response = magento_get(url)
+
+        if response.status_code != 200:
+            print(f"Error fetching {endpoint} IDs: {response.text}")
+            return None
 
-def process_data_type(data_type, from_date, to_date, table_id, id_column):
-    print(f"Processing {data_type} data...")
-    
-    if RESET == "True":
-        reset_bigquery_table(table_id)
+        page_ids = [item.get(id_field) for item in response.json().get('items') or []]
+        if not page_ids:
+            break
+
+        # A missing ID or a page that does not move past the last ID means the listing cannot be trusted
+        if any(item_id is None for item_id in page_ids):
+            print(f"Error fetching {endpoint} IDs: items without {id_field} on page {page}.")
+            return None
+        page_ids = [int(item_id) for item_id in page_ids]
+        if min(page_ids) <= last_id:
+            print(f"Error fetching {endpoint} IDs: page {page} is not past ID {last_id}.")
+            return None
+
+        ids.extend(page_ids)
+        last_id = max(page_ids)
+        print(f"Retrieved {endpoint} IDs page {page} (up to ID {last_id})...")
+
+        if len(page_ids) < RECONCILE_PAGE_SIZE:
+            break
+        page += 1
+
+    return np.unique(np.array(ids, dtype=np.int64))
+
+def bq_ids_query(table_id, id_column, has_tombstones):
+    return f"""
+        SELECT DISTINCT SAFE_CAST({id_column} AS INT64) AS id
+        FROM `{bq_table_ref(table_id)}`
+        {"WHERE Deleted_At IS NULL" if has_tombstones else ""}
+    """
+
+def fetch_bq_ids(table_id, id_column, has_tombstones):
+    """
+    Fetches the IDs still live in a BigQuery table as a sorted int64 array of unique IDs.
+    """
+    ids = run_query(bq_ids_query(table_id, id_column, has_tombstones)).to_dataframe()['id'].dropna()
+    return np.sort(ids.to_numpy(dtype=np.int64))
+
+def reconcile_deletions(data_type, table_id, id_column):
+    """
+    Finds the records loaded in BigQuery that no longer exist in Magento and, depending on RECONCILE_MODE,
+    tombstones them (Deleted_At set to the current timestamp) or deletes them, in one batched statement.
+    """
+    print(f"Reconciling deleted {data_type}...")
+    endpoint, id_field = ENTITIES[data_type]['endpoint'], ENTITIES[data_type]['id_field']
+    if isinstance(id_field, list):
+        print(f"{data_type} have a composite key, which cannot be reconciled as integer IDs. Skipping reconciliation.")
+        return
+
+    table = check_table_exists(table_id)
+    if table is None or not table.schema:
+        print(f"Nothing to reconcile in table {table_id}.")
+        return
+
+    # Never remove rows based on an incomplete or empty ID list
+    magento_ids = fetch_magento_ids(endpoint, id_field)
+    if magento_ids is None or len(magento_ids) == 0:
+        print(f"Could not get the {data_type} IDs from Magento. Skipping reconciliation.")
+        return
 
+    has_tombstones = any(field.name == 'Deleted_At' for field in table.schema)
+    bq_ids = fetch_bq_ids(table_id, id_column, has_tombstones)
 
-    # Step 1: Fetch new data based on data type
-    if data_type == 'orders':
-        df_new = fetch_all_orders(from_date, to_date)
-    elif data_type == 'customers':
-        df_new = fetch_all_customers(from_date, to_date)
+    deleted_ids = np.setdiff1d(bq_ids, magento_ids, assume_unique=True)
+    print(f"{len(magento_ids)} {data_type} in Magento, {len(bq_ids)} in BigQuery, {len(deleted_ids)} deleted.")
+    if len(deleted_ids) == 0:
+        return
+
+    table_ref = bq_table_ref(table_id)
+    if RECONCILE_MODE == "delete":
+        query = f"DELETE FROM `{table_ref}` WHERE SAFE_CAST({id_column} AS INT64) IN UNNEST(@deleted_ids)"
     else:
+        if not has_tombstones:
+            run_query(f"ALTER TABLE `{table_ref}` ADD COLUMN IF NOT EXISTS Deleted_At STRING")
+        query = f"""
+            UPDATE `{table_ref}`
+            SET Deleted_At = CAST(CURRENT_TIMESTAMP() AS STRING)
+            WHERE SAFE_CAST({id_column} AS INT64) IN UNNEST(@deleted_ids) AND Deleted_At IS NULL
+        """
+
+    job_config = bigquery.QueryJobConfig(
+        query_parameters=[bigquery.ArrayQueryParameter("deleted_ids", "INT64", deleted_ids.tolist())]
+    )
+    run_query(query, job_config=job_config)
+    print(f"{'Deleted' if RECONCILE_MODE == 'delete' else 'Tombstoned'} {len(deleted_ids)} {data_type} in table {table_id}.")
+
+# -------------------------------------------
+# -------       DRY-RUN PLANNER         -----
+# -------------------------------------------
+
+def date_slices(from_date, to_date, days):
+    """
+    Splits a date range into consecutive slices of at most the given number of days.
+    """
+    start, end = pd.Timestamp(from_date), pd.Timestamp(to_date)
+    while start <= end:
+        slice_end = min(start + pd.Timedelta(days=days - 1), end)
+        yield start.strftime("%Y-%m-%d"), slice_end.strftime("%Y-%m-%d")
+        start = slice_end + pd.Timedelta(days=1)
+
+def count_entity(spec, from_date, to_date):
+    """
+    Asks Magento for the total count of an entity with a single-item page.
+    Returns the count and the response time of the request in seconds.
+    """
+    response = magento_get(build_search_url(spec, from_date, to_date, 1, 1))
+    if response.status_code != 200:
+        raise RuntimeError(f"Error counting {spec['endpoint']}: {response.text}")
+    return response.json().get('total_count', 0), response.elapsed.total_seconds()
+
+def estimate_bq_bytes(query, query_parameters=()):
+    """
+    Returns the bytes a query would scan, from a BigQuery dry-run job (nothing is run or billed).
+    """
+    job_config = bigquery.QueryJobConfig(dry_run=True, use_query_cache=False, query_parameters=list(query_parameters))
+    return client.query(query, job_config=job_config).total_bytes_processed or 0
+
+def plan_data_types(from_date, to_date, data_types):
+    """
+    Estimates the cost of syncing data types for the current store: Magento requests and wall time
+    from the total count of each date slice, and bytes scanned by the diff, reconciliation and worst-case
+    MERGE queries from BigQuery dry-run jobs. Returns the planned Magento requests and BigQuery bytes.
+    """
+    store = get_store()
+    planned_calls = 0
+    planned_bytes = 0
+
+    for data_type in data_types:
+        spec = ENTITIES[data_type]
+        table_id, id_column = spec['table_id'], spec['primary_key']
+
+        # Magento requests, counted per date slice (replays do not call Magento)
+        calls = 0
+        seconds = 0.0
+        total_count = None
+        if REPLAY != "True":
+            slices = date_slices(from_date, to_date, PLAN_SLICE_DAYS) if spec['filter_field'] else [(from_date, to_date)]
+            total_count = 0
+            latencies = []
+            for slice_from, slice_to in slices:
+                count, latency = count_entity(spec, slice_from, slice_to)
+                print(f"[{store['name']}] {data_type} {slice_from} to {slice_to}: {count} records")
+                total_count += count
+                latencies.append(latency)
+
+            # The first page is always requested, even when the range is empty
+            calls = max(1, (total_count + spec['page_size'] - 1) // spec['page_size'])
+            if spec.get('formatter') == 'customers':
+                calls += 1  # Customer groups lookup
+            if RECONCILE == "True" and not isinstance(spec['id_field'], list):
+                # The keyset ID scan stops on the first short page, an extra empty one after full pages
+                all_count, _ = count_entity({**spec, 'filter_field': None}, from_date, to_date)
+                calls += all_count // RECONCILE_PAGE_SIZE + 1
+
+            # Requests are limited by the store's rate limit or by PAGE_WORKERS concurrent requests
+            latency = sum(latencies) / len(latencies) if latencies else 0
+            requests_per_second = min(store['rate_limit'], PAGE_WORKERS / latency) if latency > 0 else store['rate_limit']
+            seconds = calls / requests_per_second
+
+        # BigQuery bytes scanned by the queries that read the existing table (reset runs only load data)
+        bq_bytes = 0
+        table = check_table_exists(table_id)
+        if table is not None and table.schema and RESET != "True":
+            bq_bytes += estimate_bq_bytes(existing_data_query(table_id))
+            has_tombstones = any(field.name == 'Deleted_At' for field in table.schema)
+            if RECONCILE == "True" and not isinstance(spec['id_field'], list):
+                bq_bytes += estimate_bq_bytes(bq_ids_query(table_id, id_column, has_tombstones))
+
+            # Each updated record runs its own MERGE, at most one per ID. Only existing IDs can be updated, so the
+            # worst case is every fetched record (every row of the table for replays, which are not counted) being an update.
+            value_column = next((field.name for field in table.schema if field.name != id_column), None)
+            if value_column:
+                query = merge_query(table_id, id_column, [f"T.{value_column} = ''"], [id_column], ["S.id"])
+                merge_bytes = estimate_bq_bytes(query, merge_parameters('0'))
+                table_rows = table.num_rows or 0
+                merge_count = table_rows if total_count is None else min(total_count, table_rows)
+                bq_bytes += merge_bytes * merge_count
+                print(f"[{store['name']}] {data_type}: each updated record scans {merge_bytes / 1e6:.1f} MB, "
+                      f"up to {merge_count} MERGEs ({merge_bytes * merge_count / 1e6:.1f} MB) in the worst case")
+
+        print(f"[{store['name']}] {data_type}: {calls} Magento requests (~{seconds / 60:.1f} min), {bq_bytes / 1e6:.1f} MB scanned in BigQuery (at most)")
+        planned_calls += calls
+        planned_bytes += bq_bytes
+
+    return planned_calls, planned_bytes
+
+def plan_stores(stores, from_date, to_date, data_types):
+    """
+    Plans the run of every store and returns the stores within their budgets.
+    The requests and bytes used by the planning itself are not counted against the run.
+    """
+    stores_within_budget = []
+    for store in stores:
+        store['planning'] = True
+        try:
+            planned_calls, planned_bytes = run_for_store(store, plan_data_types, from_date, to_date, data_types)
+        except Exception as e:
+            print(f"[{store['name']}] Could not plan the run: {str(e)}")
+            continue
+        finally:
+            store['planning'] = False
+            store['api_calls'] = 0
+            store['bq_bytes'] = 0
+
+        print(f"[{store['name']}] Planned total: {planned_calls} Magento requests, {planned_bytes / 1e6:.1f} MB scanned in BigQuery (at most)")
+        if MAX_API_CALLS is not None and planned_calls > MAX_API_CALLS:
+            print(f"[{store['name']}] Over MAX_API_CALLS ({MAX_API_CALLS}). Skipping this store.")
+        elif MAX_BQ_BYTES is not None and planned_bytes > MAX_BQ_BYTES:
+            print(f"[{store['name']}] Over MAX_BQ_BYTES ({MAX_BQ_BYTES}). Skipping this store.")
+        else:
+            stores_within_budget.append(store)
+
+    return stores_within_budget
+
+# -------------------------------------------
+# -------         MAIN FUNCTION         -----
+# -------------------------------------------
+
+
+def fetch_data_type(data_type, from_date, to_date):
+    print(f"Fetching {data_type} data...")
+    
+    # Step 1: Fetch new data with the spec of the data type
+    if data_type not in ENTITIES:
         print(f"Unsupported data type: {data_type}")
-        return
+        return pd.DataFrame()
+    return fetch_entity(data_type, from_date, to_date)
+
+
+def process_data_type(data_type, df_new, table_id, id_column):
+    print(f"Processing {data_type} data...")
     
     if df_new.empty:
         print(f"No {data_type} data found for the specified date range.")
         return
     
+    # Derived columns are computed in the view, never stored in or compared against the base table
+    derived_columns = list(DERIVED_COLUMNS.get(table_id, {}))
+    df_new = df_new.drop(columns=[col for col in derived_columns if col in df_new.columns])
+    
+    # Reset runs rebuild the table in a shadow table and swap it in at the end,
+    # so the live table keeps serving its current data until the new one is complete
+    if RESET == "True":
+        shadow_ref = build_shadow_table(table_id, df_new)
+        swap_shadow_table(table_id, shadow_ref)
+        create_derived_view(table_id)
+        print(f"Completed processing {data_type} data.")
+        return
+    
     # Step 2: Check if the table exists
     table = check_table_exists(table_id)
     
@@ -728,6 +1312,7 @@ def process_data_type(data_type, from_date, to_date, table_id, id_column):
                 # Upload all data as new
                 upload_to_bq(df_new, table_id)
                 print(f"Recreated table {table_id} with schema and uploaded {len(df_new)} records.")
+                create_derived_view(table_id)
                 return
         except Exception as e:
             # If we can't check schema, we'll continue and handle errors in fetch_existing_data_from_bq
@@ -747,7 +1332,7 @@ def process_data_type(data_type, from_date, to_date, table_id, id_column):
         else:
             # Normal flow - compare and update data
             print("Beginning BigQuery operations...") 
-            new_records, updated_records = compare_and_update_data(df_new, df_existing, id_column)
+            new_records, updated_records = compare_and_update_data(df_new, df_existing, id_column, exclude_columns=derived_columns)
             print(f"Data comparison complete. Found {len(new_records)} new and {len(updated_records)} updated records.")
 
             # Insert new records into BigQuery
@@ -764,7 +1349,66 @@ def process_data_type(data_type, from_date, to_date, table_id, id_column):
             else:
                 print(f"No {data_type} updates found.")
     
+    create_derived_view(table_id)
     print(f"Completed processing {data_type} data.")
+
+
+def load_data_type(data_type, df_new, table_id, id_column):
+    process_data_type(data_type, df_new, table_id, id_column)
+
+    # Reconcile deletions (needs Magento, so not available in replay mode)
+    if RECONCILE == "True" and REPLAY != "True":
+        reconcile_deletions(data_type, table_id, id_column)
+
+
+def sync_stores(stores, from_date, to_date, data_types):
+    """
+    Syncs every store through shared pools of fetch and load workers.
+    Fetch jobs are queued round-robin across stores (every store's first data type, then every store's
+    second one, ...), so each store gets its turn even with more stores than workers, and each store's
+    requests stay within its own rate budget. A load job is queued as soon as its fetch completes.
+    At most FETCH_WORKERS + LOAD_WORKERS fetched frames are held at once: when loads fall behind,
+    the next fetches wait for a load to complete instead of piling up frames in memory.
+    """
+    frame_slots = threading.BoundedSemaphore(FETCH_WORKERS + LOAD_WORKERS)
+
+    def fetch_job(store, data_type):
+        # The slot is released once the frame is loaded, or right away if the fetch fails
+        frame_slots.acquire()
+        try:
+            return run_for_store(store, fetch_data_type, data_type, from_date, to_date)
+        except Exception:
+            frame_slots.release()
+            raise
+
+    with ThreadPoolExecutor(max_workers=FETCH_WORKERS) as fetch_pool, ThreadPoolExecutor(max_workers=LOAD_WORKERS) as load_pool:
+        fetch_jobs = {}
+        for data_type in data_types:
+            table_id, id_column = ENTITIES[data_type]['table_id'], ENTITIES[data_type]['primary_key']
+            for store in stores:
+                future = fetch_pool.submit(fetch_job, store, data_type)
+                fetch_jobs[future] = (store, data_type, table_id, id_column)
+
+        load_jobs = {}
+        for future in as_completed(fetch_jobs):
+            store, data_type, table_id, id_column = fetch_jobs[future]
+            try:
+                df_new = future.result()
+            except Exception as e:
+                print(f"[{store['name']}] Error fetching {data_type}: {str(e)}")
+                continue
+            future = load_pool.submit(run_for_store, store, load_data_type, data_type, df_new, table_id, id_column)
+            future.add_done_callback(lambda _: frame_slots.release())
+            load_jobs[future] = (store, data_type)
+
+        for future in as_completed(load_jobs):
+            store, data_type = load_jobs[future]
+            try:
+                future.result()
+                print(f"[{store['name']}] {data_type} in sync.")
+            except Exception as e:
+                print(f"[{store['name']}] Error loading {data_type}: {str(e)}")
+
 # -------------------------------------------
 # -------             RUN               -----
 # -------------------------------------------
@@ -772,13 +1416,16 @@ def process_data_type(data_type, from_date, to_date, table_id, id_column):
 # Set the Google Cloud credentials environment variable
 os.environ['GOOGLE_APPLICATION_CREDENTIALS'] = BQ_PATH_KEY
 
-# Initialize a BigQuery client
+# Initialize a BigQuery client (thread-safe, shared by every store and worker)
 client = bigquery.Client(project=BQ_PROJECT_ID)
 
-# Process customer data
-process_data_type('customers', FROM_DATE, TO_DATE, BQ_CUSTOMER_TABLE_ID, "Customer_ID")
-# Process order data
-process_data_type('orders', FROM_DATE, TO_DATE, BQ_ORDER_TABLE_ID, "Order_ID")
+# Plan the run when asked to, or when budgets have to be checked before it starts
+if PLAN == "True" or MAX_API_CALLS is not None or MAX_BQ_BYTES is not None:
+    stores = plan_stores(stores, FROM_DATE, TO_DATE, SYNC_ENTITIES)
+
+# Sync the registered entities of every store (dry runs stop after the plan)
+if PLAN != "True":
+    sync_stores(stores, FROM_DATE, TO_DATE, SYNC_ENTITIES)
 
 
 